@@ -5,16 +5,18 @@ from datetime import datetime
 
 # Third Party
 import numpy as np
-import pandas as pd
-import ruptures as rpt
-from metric_model import ArimaModel
+from metric_model import ArimaModel, PageHinkley, locate_change
 
 ## configurable parameters
-RETRAINING_INTERVAL_MINUTE = 1
+RETRAINING_INTERVAL_MINUTE = int(
+    os.getenv("RETRAINING_INTERVAL_MINUTE", 1)
+)  ## forecast this many minutes ahead each time the model is updated
+REFIT_INTERVAL_MINUTE = 60  ## re-estimate model parameters every hour
 ROLLING_TRAINING_SIZE = 1440
 MIN_TRAINING_SIZE = 30
 ALERT_SCORE_THRESHOLD = 5
 CPD_TRACE_BACK_TIME = 30  ## minutes
+CPD_ANOMALY_DISTANCE = 5  ## minutes, max distance from a change point to an anomaly
 LOOP_TIME_SECOND = float(
     os.getenv("LOOP_TIME_SECOND", 60.0)
 )  # 60.0   # unit: second, type: float
@@ -26,75 +28,166 @@ logger.setLevel(LOGGING_LEVEL)
 
 
 class MetricAnomalyDetector:
+    # an anomaly is a data point outside the predicted bounds, the model can't explain it
+    REFIT_ON_ANOMALY = True
+
     def __init__(self, metric_name, cluster_id):
         self.cluster_id = cluster_id
         self.metric_name = metric_name
-        self.metric_xs = []
-        self.metric_y = []
-        self.metric_rawy = []
-        self.pred_history = []
+        self.last_minute = -1  # timestamp of the latest data point in minutes
+        # ring buffers holding the latest [ROLLING_TRAINING_SIZE] data points
+        self.metric_y = np.empty(ROLLING_TRAINING_SIZE, dtype=np.float64)
+        self.metric_rawy = np.empty(ROLLING_TRAINING_SIZE, dtype=np.float64)
+        self.anomaly_history = np.zeros(ROLLING_TRAINING_SIZE, dtype=np.int8)
+        # predicted values, NaN until the model has enough training data
+        self.yhat = np.full(ROLLING_TRAINING_SIZE, np.nan)
+        self.yhat_lower = np.full(ROLLING_TRAINING_SIZE, np.nan)
+        self.yhat_upper = np.full(ROLLING_TRAINING_SIZE, np.nan)
+        self.count = 0  # number of data points seen so far
         self.alert_score_counter = 0
         self.metric_model = ArimaModel()
-        self.anomaly_history = []
+        self.cpd = PageHinkley()
+        self.change_detected_at = None  # index of a change yet to be located
         self.start_index = 0
         self.anomaly_start_time = None
+        self.fitted_size = 0  # number of data points the model has consumed
+        self.last_refit_size = 0
+        self.refit_required = True
+        # fields that never change for a detector, copied into every payload
+        self.payload_template = {
+            "cluster_id": cluster_id,
+            "metric_name": metric_name,
+            "alert_score": 0,
+            "confidence_score": 0,
+        }
         # start index of training data. update by CPD and rolling time-window. For example if there's 2000 data points in the list, start_index should be 560.
 
     def load(self, history_data):
-        for h in history_data:
-            d = h["_source"]
-            self.metric_xs.append(datetime.fromisoformat(d["timestamp"]))
-            self.metric_y.append(d["y"])
-            self.metric_rawy.append(d["y"])
-            self.pred_history.append((d["yhat"], d["yhat_lower"], d["yhat_upper"]))
-            self.anomaly_history.append(d["is_anomaly"])
-        logger.debug(f"history data loaded : {len(self.metric_xs)}")
+        """
+        load the ES hits of previously indexed payloads into the buffers.
+        The hits have to be in ascending timestamp order, query them with
+        "sort": [{"timestamp": {"order": "asc"}}] so they can be passed as is.
+        """
+        # only the latest [ROLLING_TRAINING_SIZE] data points fit in the buffers
+        history = [h["_source"] for h in history_data][-ROLLING_TRAINING_SIZE:]
+        if len(history) == 0:
+            return
+        self.load_arrays(
+            datetime.fromisoformat(history[-1]["timestamp"]).timestamp(),
+            np.array([d["y"] for d in history], dtype=np.float64),
+            np.array([d["is_anomaly"] for d in history], dtype=np.int8),
+            *(
+                np.array([d[column] for d in history], dtype=np.float64)
+                for column in ["yhat", "yhat_lower", "yhat_upper"]
+            ),  # missing predictions become NaN
+        )
+
+    def load_arrays(
+        self,
+        last_timestamp,
+        y,
+        is_anomaly=None,
+        yhat=None,
+        yhat_lower=None,
+        yhat_upper=None,
+    ):
+        """
+        load history data points given as arrays in time order, [last_timestamp] is the
+        timestamp in seconds of the latest one. Without [is_anomaly] the data points are
+        considered normal, without predictions the predicted values are NaN.
+        """
+        y = np.asarray(y, dtype=np.float64)[-ROLLING_TRAINING_SIZE:]
+        if len(y) == 0:
+            return
+        i = np.arange(self.count, self.count + len(y)) % ROLLING_TRAINING_SIZE
+        self.metric_y[i] = y
+        self.metric_rawy[i] = y
+        self.anomaly_history[i] = 0 if is_anomaly is None else is_anomaly[-len(y) :]
+        for buffer, values in [
+            (self.yhat, yhat),
+            (self.yhat_lower, yhat_lower),
+            (self.yhat_upper, yhat_upper),
+        ]:
+            buffer[i] = np.nan if values is None else values[-len(y) :]
+        self.count += len(y)
+        if self.count - self.start_index > ROLLING_TRAINING_SIZE:
+            self.start_index = self.count - ROLLING_TRAINING_SIZE
+        self.last_minute = int(last_timestamp // LOOP_TIME_SECOND)
+        logger.debug(f"history data loaded : {self.count}")
+
+    def push(self, y_train, y_raw, is_anomaly):
+        """
+        write a new data point to the ring buffers.
+        """
+        i = self.count % ROLLING_TRAINING_SIZE
+        self.metric_y[i] = y_train
+        self.metric_rawy[i] = y_raw
+        self.anomaly_history[i] = is_anomaly
+        self.count += 1
+        ## max training size should be [ROLLING_TRAINING_SIZE]
+        if self.count - self.start_index > ROLLING_TRAINING_SIZE:
+            self.start_index = self.count - ROLLING_TRAINING_SIZE
+
+    def window(self, buffer, start):
+        """
+        return the data points of a ring buffer from index [start] to the latest one, in time order.
+        The result is a view of the buffer unless the window wraps around the end of it.
+        """
+        begin = start % ROLLING_TRAINING_SIZE
+        end = begin + self.count - start
+        if end <= ROLLING_TRAINING_SIZE:
+            return buffer[begin:end]
+        return np.concatenate((buffer[begin:], buffer[: end - ROLLING_TRAINING_SIZE]))
+
+    def timestamp_of(self, index):
+        """
+        return the timestamp of the data point at [index].
+        """
+        minute = self.last_minute - (self.count - 1 - index)
+        return datetime.fromtimestamp(minute * LOOP_TIME_SECOND)
 
     def run(self, data):
         xs_raw, y_raw = data[0]["value"]
-        xs_raw = (
-            int(xs_raw) // LOOP_TIME_SECOND * LOOP_TIME_SECOND
-        )  ## convert time to start of minute :00
-        xs_new = datetime.fromtimestamp(float(xs_raw))
-        if xs_new in self.metric_xs:
+        minute = int(float(xs_raw) // LOOP_TIME_SECOND)
+        if minute <= self.last_minute:
             logger.warning("ERROR: duplicated timestamp!")
             return None
+        xs_raw = minute * LOOP_TIME_SECOND  ## convert time to start of minute :00
+        xs_new = datetime.fromtimestamp(xs_raw)
         y_new = float(y_raw)
 
-        self.train_and_predict()
+        if (
+            self.count >= MIN_TRAINING_SIZE
+            and self.count - self.fitted_size >= RETRAINING_INTERVAL_MINUTE
+        ):  # the previous forecast covers the data points up to here
+            self.train_and_predict()
         is_anomaly = 0
         is_alert = 0
         alert_len = None
-        json_payload = {
-            "cluster_id": self.cluster_id,
-            "timestamp": xs_new,  # xs_new.isoformat(),
-            "is_anomaly": is_anomaly,
-            "metric_name": self.metric_name,
-            "alert_score": 0,
-            "is_alert": is_alert,
-            "y": y_new,
-            "yhat": y_new,
-            "yhat_lower": y_new,
-            "yhat_upper": y_new,
-            "confidence_score": 0,
-            "alert_id": self.anomaly_start_time,
-            "alert_len": alert_len,
-        }
-        if len(self.metric_xs) >= MIN_TRAINING_SIZE:
-            y_pred, y_pred_low, y_pred_high = self.pred_history[len(self.metric_xs)]
-            if self.metric_name == "disk_usage":
-                y_pred = None
-                y_pred_high = 80
-                is_anomaly = 1 if y_new >= y_pred_high else 0  # trigger: above boundary
-            else:
-                is_anomaly = (
-                    1 if (y_new < y_pred_low or y_new > y_pred_high) else 0
-                )  # trigger: above or below
+        json_payload = self.payload_template.copy()
+        json_payload["timestamp"] = xs_new  # xs_new.isoformat(),
+        json_payload["timestamp_ms"] = int(xs_raw) * 1000
+        json_payload["is_anomaly"] = is_anomaly
+        json_payload["is_alert"] = is_alert
+        json_payload["y"] = y_new
+        json_payload["yhat"] = y_new
+        json_payload["yhat_lower"] = y_new
+        json_payload["yhat_upper"] = y_new
+        json_payload["alert_id"] = self.anomaly_start_time
+        json_payload["alert_len"] = alert_len
+        y_train = y_new
+        if self.count >= MIN_TRAINING_SIZE:
+            i = self.count % ROLLING_TRAINING_SIZE
+            is_anomaly, y_pred, y_pred_low, y_pred_high = self.classify(
+                y_new, self.yhat[i], self.yhat_lower[i], self.yhat_upper[i]
+            )
 
             if is_anomaly == 1:
                 if self.alert_score_counter == 0:
                     self.anomaly_start_time = xs_raw
                 self.alert_score_counter += 1
+                if self.REFIT_ON_ANOMALY:
+                    self.refit_required = True  # the model can't explain the new data
             else:
                 if self.alert_score_counter > 0:
                     self.alert_score_counter -= 2
@@ -124,32 +217,28 @@ class MetricAnomalyDetector:
             json_payload["alert_score"] = self.alert_score_counter
             json_payload["alert_id"] = self.anomaly_start_time
             json_payload["alert_len"] = alert_len
+            y_train = self.correct(y_new, is_anomaly, is_alert, y_pred_low, y_pred_high)
 
-        else:  ## for first 10 mins, simply use y as pred values
-            self.pred_history.append((None, None, None))
-
-        if self.metric_name == "cpu_usage" and is_alert == 0 and is_anomaly == 1:
-            logger.debug("Experimental: correct anomaly value.")
-            if y_new < y_pred_low:
-                y_train = y_pred_low
-            else:
-                y_train = y_pred_high
-        else:
-            y_train = y_new
+        self.last_minute = minute
+        self.push(y_train, y_new, is_anomaly)
 
-        self.anomaly_history.append(is_anomaly)
-        self.metric_xs.append(xs_new)
-        self.metric_y.append(y_train)
-        self.metric_rawy.append(y_new)
+        return json_payload
 
-        if (
-            len(self.anomaly_history) >= CPD_TRACE_BACK_TIME
-            and self.anomaly_history[-CPD_TRACE_BACK_TIME] == 1
-            and self.metric_name == "cpu_usage"
-        ):
-            self.change_point_detection()
+    def classify(self, y_new, y_pred, y_pred_low, y_pred_high):
+        """
+        decide whether the new data point is an anomaly given its prediction.
+        returns the anomaly flag and the prediction and bounds to report.
+        """
+        is_anomaly = (
+            1 if (y_new < y_pred_low or y_new > y_pred_high) else 0
+        )  # trigger: above or below
+        return is_anomaly, y_pred, y_pred_low, y_pred_high
 
-        return json_payload
+    def correct(self, y_new, is_anomaly, is_alert, y_pred_low, y_pred_high):
+        """
+        return the value of the new data point to train the model with.
+        """
+        return y_new
 
     def update_alert_score(self, is_anomaly):
         """
@@ -183,46 +272,134 @@ class MetricAnomalyDetector:
             return 1
         return 0
 
-    def change_point_detection(self):
+    def change_point_detection(self, y):
         """
         change point detection function.
-        This is to find the change points in the time-series trend (in terms of changed mean or variance).
-        """
-        training_y = self.metric_y[self.start_index :]
-        if len(training_y) >= 2 * CPD_TRACE_BACK_TIME:
-            cpd = rpt.Pelt(model="rbf").fit(np.array(training_y))
-            change_locations = (cpd.predict(pen=10))[
-                :-1
-            ]  # remove last one because it's always the end of array so it's meaningless
-            for l in reversed(change_locations):
-                if (
-                    abs(l - len(training_y) + CPD_TRACE_BACK_TIME) <= 5
-                ):  # the change point should nearby an anomaly
-                    logger.debug(
-                        f"reset start_index from {self.metric_xs[self.start_index]} to {self.metric_xs[self.start_index + l]}"
-                    )
-                    self.start_index = self.start_index + l
-                    break
+        This is to find the change points in the time-series trend (in terms of changed mean). The Page-Hinkley
+        test detects a change online, then [CPD_TRACE_BACK_TIME] data points later the change is located and,
+        if it's near an anomaly, the training data is reset to start from it.
+        """
+        if self.cpd.update(y, self.count - 1) and self.change_detected_at is None:
+            self.change_detected_at = self.count - 1
+        if (
+            self.change_detected_at is None
+            or self.count - 1 - self.change_detected_at < CPD_TRACE_BACK_TIME
+        ):
+            return
+
+        segment_start = max(self.cpd.start, self.start_index)
+        change_index = segment_start + locate_change(
+            self.window(self.metric_y, segment_start)
+        )
+        lo = max(change_index - CPD_ANOMALY_DISTANCE, segment_start)
+        if (
+            # keep at least [MIN_TRAINING_SIZE] data points to train on
+            change_index <= self.count - MIN_TRAINING_SIZE
+            and self.window(self.anomaly_history, lo)[
+                : change_index + CPD_ANOMALY_DISTANCE + 1 - lo
+            ].any()
+        ):  # the change point should nearby an anomaly
+            logger.debug(
+                f"reset start_index from {self.timestamp_of(self.start_index)} to {self.timestamp_of(change_index)}"
+            )
+            self.start_index = change_index
+            self.refit_required = True
+        self.cpd.reset()
+        self.change_detected_at = None
 
     def train_and_predict(self):
         """
         modeling includes train and predict.
-        every time there's a new data point, train a new model and forecast one step in future.
-        """
-        if len(self.metric_xs) >= MIN_TRAINING_SIZE:
-            tdf = pd.Series(self.metric_y, self.metric_xs)
-            training_dataseries = (tdf[~tdf.index.duplicated(keep="first")]).asfreq(
-                freq="T"
-            )  ## TODO: better efficiency
-            ## max training size should be [ROLLING_TRAINING_SIZE]
-            if len(self.metric_y) - self.start_index > ROLLING_TRAINING_SIZE:
-                self.start_index = len(self.metric_y) - ROLLING_TRAINING_SIZE
-            training_dataseries = training_dataseries[self.start_index :]
+        every [RETRAINING_INTERVAL_MINUTE] data points, forecast that many steps in future. The model parameters are only
+        re-estimated every [REFIT_INTERVAL_MINUTE] or after a change point, in between the new data points
+        are appended to the fitted model.
+        """
+        if (
+            self.refit_required
+            or self.count - self.last_refit_size >= REFIT_INTERVAL_MINUTE
+        ):
+            # copy the window since the fitted model keeps a reference to its data
+            training_y = self.window(self.metric_y, self.start_index).copy()
 
             eval_interval = 10  # every 10 mins
             # if len(training_dataseries) % eval_interval == 0:
-            #     self.metric_model.evaluate(training_dataseries)
-            self.metric_model.train(training_dataseries)
-            preds, lower_bounds, upper_bounds = self.metric_model.predict()
-            for p in zip(preds, lower_bounds, upper_bounds):
-                self.pred_history.append(p)
+            #     self.metric_model.evaluate(training_y)
+            self.metric_model.train(training_y)
+            self.last_refit_size = self.count
+            self.refit_required = False
+        else:
+            self.metric_model.append(self.window(self.metric_y, self.fitted_size))
+        self.fitted_size = self.count
+
+        preds, lower_bounds, upper_bounds = self.metric_model.predict()
+        i = np.arange(self.count, self.count + len(preds)) % ROLLING_TRAINING_SIZE
+        self.yhat[i] = preds
+        self.yhat_lower[i] = lower_bounds
+        self.yhat_upper[i] = upper_bounds
+
+
+class CpuUsageAnomalyDetector(MetricAnomalyDetector):
+    def run(self, data):
+        json_payload = super().run(data)
+        if json_payload:
+            self.change_point_detection(
+                self.metric_y[(self.count - 1) % ROLLING_TRAINING_SIZE]
+            )
+        return json_payload
+
+    def correct(self, y_new, is_anomaly, is_alert, y_pred_low, y_pred_high):
+        if is_alert == 0 and is_anomaly == 1:
+            logger.debug("Experimental: correct anomaly value.")
+            if y_new < y_pred_low:
+                return y_pred_low
+            return y_pred_high
+        return y_new
+
+
+class DiskUsageAnomalyDetector(MetricAnomalyDetector):
+    DISK_USAGE_THRESHOLD = 80
+    # the anomaly is a fixed threshold, it says nothing about the model
+    REFIT_ON_ANOMALY = False
+
+    def classify(self, y_new, y_pred, y_pred_low, y_pred_high):
+        y_pred_high = self.DISK_USAGE_THRESHOLD
+        is_anomaly = 1 if y_new >= y_pred_high else 0  # trigger: above boundary
+        return is_anomaly, None, y_pred_low, y_pred_high
+
+
+## metrics without a specialized detector, e.g. memory_usage, use MetricAnomalyDetector.
+DETECTOR_CLASSES = {
+    "cpu_usage": CpuUsageAnomalyDetector,
+    "disk_usage": DiskUsageAnomalyDetector,
+}
+
+
+def make_mad(metric_name, cluster_id):
+    """
+    create the anomaly detector of a metric.
+    """
+    detector_class = DETECTOR_CLASSES.get(metric_name, MetricAnomalyDetector)
+    return detector_class(metric_name, cluster_id)
+
+
+# detectors owned by this process, keyed by (cluster_id, metric_name)
+DETECTORS = dict()
+
+
+def run_anomaly_detection(cluster_id, metrics_data):
+    """
+    run the anomaly detectors of a cluster on newly scraped data and return their json payloads.
+    The detectors are created on first use and kept in the process that runs them, so all the
+    calls for a cluster have to be routed to the same worker process.
+    """
+    metrics_payloads = []
+    for metric_name, data in metrics_data.items():
+        if len(data) == 0:
+            continue
+        key = (cluster_id, metric_name)
+        if key not in DETECTORS:
+            DETECTORS[key] = make_mad(metric_name, cluster_id)
+        json_payload = DETECTORS[key].run(data)
+        if json_payload:
+            metrics_payloads.append(json_payload)
+    return metrics_payloads
@@ -3,11 +3,11 @@ import logging
 import os
 import time
 from abc import abstractmethod
-from math import sqrt
 
 # Third Party
 import numpy as np
 import pandas as pd
+from scipy.stats import norm
 from statsmodels.tsa.statespace.sarimax import SARIMAX
 
 # from statsmodels.tsa.api import ExponentialSmoothing, SimpleExpSmoothing, Holt
@@ -18,7 +18,7 @@ logger = logging.getLogger(__file__)
 logger.setLevel(LOGGING_LEVEL)
 
 N_TEST = 10
-RETRAINING_INTERVAL_MINUTE = 1
+RETRAINING_INTERVAL_MINUTE = int(os.getenv("RETRAINING_INTERVAL_MINUTE", 1))
 confidence_interval_level = 3  ## should be 2(95%) or 3(99.7%) or 2.57(99%)
 
 
@@ -32,13 +32,59 @@ class MetricModel:
         pass
 
 
+class PageHinkley:
+    """
+    Online change point detection with the two-sided Page-Hinkley test: https://doi.org/10.1093/biomet/41.1-2.100
+    It tracks the cumulative deviation of the data from its running mean, and reports a change when the
+    deviation rises above its minimum by more than [threshold]. Each update is O(1).
+    """
+
+    def __init__(self, delta=0.5, threshold=50):
+        self.delta = delta  # magnitude of changes to tolerate
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.start = None  # index of the first data point since the last change
+        self.n = 0
+        self.mean = 0.0
+        self.sum_up, self.min_up = 0.0, 0.0
+        self.sum_down, self.min_down = 0.0, 0.0
+
+    def update(self, y, index):
+        """
+        add the data point at [index] to the test. returns True if a change is detected since [self.start].
+        """
+        if self.n == 0:
+            self.start = index
+        self.n += 1
+        self.mean += (y - self.mean) / self.n
+        self.sum_up += y - self.mean - self.delta  # detects increases
+        self.sum_down += self.mean - y - self.delta  # detects decreases
+        self.min_up = min(self.min_up, self.sum_up)
+        self.min_down = min(self.min_down, self.sum_down)
+        return (
+            self.sum_up - self.min_up > self.threshold
+            or self.sum_down - self.min_down > self.threshold
+        )
+
+
+def locate_change(data):
+    """
+    locate the most likely change of mean in the data: the split with the largest CUSUM statistic.
+    returns the index of the first data point after the change.
+    """
+    cusum = np.cumsum(data - data.mean())
+    return int(np.argmax(np.abs(cusum[:-1]))) + 1
+
+
 def train_test_split(data, n_test):
     # take last n datapoint as test data.
     return data[:-n_test], data[-n_test:]
 
 
 def measure_rmse(actual, predicted):
-    return sqrt(np.square(np.subtract(actual, predicted)).mean())
+    return np.sqrt(np.square(np.subtract(actual, predicted)).mean())
 
 
 def walk_forward_evaluation(data_series, config):
@@ -46,15 +92,18 @@ def walk_forward_evaluation(data_series, config):
     n_test = N_TEST
     predictions = []
     training, testing = train_test_split(data_series, n_test)
-    history = [x for x in training]
+    history = np.empty(len(training) + n_test, dtype=np.float64)
+    history[: len(training)] = training
+    cursor = len(training)
 
     for t in testing:
-        model = SARIMAX(history, order=order, seasonal_order=seasonal_order).fit(
-            disp=False
-        )
+        model = SARIMAX(
+            history[:cursor], order=order, seasonal_order=seasonal_order
+        ).fit(disp=False)
         yhat = model.forecast(1)[0]  # predict the next value
         predictions.append(yhat)
-        history.append(t)
+        history[cursor] = t
+        cursor += 1
     rmse = measure_rmse(testing, predictions)
     return rmse
 
@@ -77,12 +126,29 @@ class ArimaModel(MetricModel):
                 if confidence_interval_level == 2
                 else 0.01
             )
+        # half-width of the confidence interval, in standard errors
+        self.z = norm.ppf(1 - self.alpha / 2)
         self.model = None
 
-    def train(self, data_series: pd.Series):
+    def train(self, data_series: np.ndarray):
+        # warm-start from the previous estimate, it is usually close to the new optimum
+        start_params = None
+        if (
+            self.model is not None
+            and self.model.model.order == self.order
+            and self.model.model.seasonal_order == self.seasonal_order
+        ):
+            start_params = self.model.params
         self.model = SARIMAX(
             data_series, order=self.order, seasonal_order=self.seasonal_order
-        ).fit(disp=False)
+        ).fit(start_params=start_params, disp=False)
+
+    def append(self, new_data):
+        """
+        extend the fitted model with new observations without re-estimating the parameters.
+        the Kalman filter continues from its last state over the new data only, which is much cheaper than a full fit.
+        """
+        self.model = self.model.extend(new_data)
 
     def evaluate(self, data_series: pd.Series):
         # walk-forward evaluation, and parameter selection
@@ -98,11 +164,8 @@ class ArimaModel(MetricModel):
         )
 
     def predict(self):
-        fc_series = self.model.forecast(RETRAINING_INTERVAL_MINUTE)  # get yhat
-        intervals = self.model.get_forecast(
-            RETRAINING_INTERVAL_MINUTE
-        ).conf_int(  # get yhat_lower and yhat_upper
-            alpha=self.alpha
-        )
-        lower_series, upper_series = intervals["lower y"], intervals["upper y"]
-        return fc_series, lower_series, upper_series
+        forecast = self.model.get_forecast(RETRAINING_INTERVAL_MINUTE)
+        fc_series = forecast.predicted_mean  # get yhat
+        # get yhat_lower and yhat_upper, same as forecast.conf_int(alpha=self.alpha)
+        margin = self.z * np.sqrt(forecast.var_pred_mean)
+        return fc_series, fc_series - margin, fc_series + margin
@@ -3,16 +3,25 @@ import asyncio
 import logging
 import os
 import time
-import uuid
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from urllib.parse import quote
 
 # Third Party
-from elasticsearch import AsyncElasticsearch
-from elasticsearch.exceptions import ConnectionTimeout
-from elasticsearch.helpers import BulkIndexError, async_streaming_bulk
+import orjson
+from elasticsearch import AIOHttpConnection, AsyncElasticsearch
+from elasticsearch.exceptions import ElasticsearchException, SerializationError
+from elasticsearch.serializer import JSONSerializer
 from fastapi import FastAPI
-from metric_anomaly_detector import MetricAnomalyDetector
-from prometheusConnector import PrometheusConnect, list_clusters, push_metrics
+from metric_anomaly_detector import run_anomaly_detection
+from prometheusConnector import (
+    PrometheusConnect,
+    gateway_client,
+    list_clusters,
+    push_metrics,
+)
 
 app = FastAPI()
 
@@ -29,17 +38,50 @@ prom = PrometheusConnect(
     cert=("/run/cortex/certs/client/tls.crt", "/run/cortex/certs/client/tls.key"),
     verify="/run/cortex/certs/server/ca.crt",
 )
-logger.info(f"prom connect status check OK?: {prom.check_prometheus_connection()}")
 LOOP_TIME_SECOND = float(
     os.getenv("LOOP_TIME_SECOND", 60.0)
 )  # 60.0  # unit: second, type: float
+LOOP_TIME_NS = round(LOOP_TIME_SECOND * 1_000_000_000)
 ROLLING_TRAINING_SIZE = 1440
+# os.cpu_count() is the host's CPU count in a container, so the default is capped
+ANOMALY_DETECTION_WORKERS = int(
+    os.getenv("ANOMALY_DETECTION_WORKERS", min(4, os.cpu_count() or 1))
+)
+
+
+class ORJsonSerializer(JSONSerializer):
+    """
+    JSON serializer of the ES client backed by orjson, it parses the responses and
+    serializes the request bodies that are not pre-serialized.
+    """
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        if isinstance(data, (str, bytes)):  # the bulk body is already serialized
+            return data
+        try:
+            return orjson.dumps(
+                data, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY
+            ).decode()
+        except TypeError as e:
+            raise SerializationError(data, e)
+
 
 ES_ENDPOINT = os.getenv("ES_ENDPOINT", None)
 if ES_ENDPOINT:
     ES_USERNAME = os.getenv("ES_USERNAME", "admin")
     ES_PASSWORD = os.getenv("ES_PASSWORD", "admin")
     ES_INDEX = "opni-metric"
+    ES_FLUSH_INTERVAL_SECOND = float(os.getenv("ES_FLUSH_INTERVAL_SECOND", 30.0))
+    ES_FLUSH_SIZE = 50  # flush early once this many documents are buffered
+    ES_BULK_CHUNK_SIZE = 100  # max number of documents in a bulk request
+    ES_BULK_CONCURRENCY = 4  # max number of bulk requests in flight
+    ES_BULK_REQUEST_TIMEOUT_SECOND = 30
 
     ES_RESERVED_KEYWORDS = {
         "_id",
@@ -59,8 +101,13 @@ if ES_ENDPOINT:
     es = AsyncElasticsearch(
         [ES_ENDPOINT],
         port=9200,
+        connection_class=AIOHttpConnection,
+        serializer=ORJsonSerializer(),
+        maxsize=16,  # connections kept open, so concurrent requests don't queue
+        sniff_on_start=False,
+        sniff_on_connection_fail=False,
         http_auth=(ES_USERNAME, ES_PASSWORD),
-        http_compress=True,
+        http_compress=False,  # the bulk bodies are a few KB, not worth gzipping
         verify_certs=False,
         use_ssl=False,
         timeout=10,
@@ -75,13 +122,28 @@ metrics_list = [
 ]  ## TODO: default metrics and their queries should be configured in a file.
 
 
+ES_BUFFER = deque()  # detector payloads waiting to be indexed to ES
 GAUGE_DICT = dict()
 MAD_DICT = dict()
+# the running detect_anomalies tasks, the event loop only keeps weak references to them
+DETECTION_TASKS = set()
+# one single-process executor per shard, a metric of a cluster always goes to the
+# same shard so that its detector keeps its state.
+EXECUTORS = [
+    ProcessPoolExecutor(max_workers=1) for _ in range(ANOMALY_DETECTION_WORKERS)
+]
 PROMETHEUS_CUSTOM_QUERIES = {
     "cpu_usage": 'sum (rate (container_cpu_usage_seconds_total{id="/"}[5m])) / sum (machine_cpu_cores) * 100',
     "memory_usage": 'sum (container_memory_working_set_bytes{id="/"}) / sum (machine_memory_bytes) * 100',
     "disk_usage": 'sum (container_fs_usage_bytes{id="/"}) / sum (container_fs_limit_bytes{id="/"}) * 100',
 }
+# all the queries in one, each result is tagged with a "metric_name" label.
+PROMETHEUS_QUERY = " or ".join(
+    f'label_replace({query}, "metric_name", "{metric_name}", "", "")'
+    for metric_name, query in PROMETHEUS_CUSTOM_QUERIES.items()
+)
+# the query never changes, URL-encode it once instead of on every request.
+PROMETHEUS_QUERY_ENCODED = quote(PROMETHEUS_QUERY, safe="")
 COLUMNS_LIST = [
     "is_anomaly",
     "alert_score",
@@ -93,114 +155,224 @@ COLUMNS_LIST = [
     "yhat_lower",
     "yhat_upper",
 ]
+# fields of a detector payload indexed to ES, none of them is reserved by ES.
+ES_DOC_KEYS = tuple(COLUMNS_LIST) + (
+    "cluster_id",
+    "metric_name",
+    "timestamp",
+    "confidence_score",
+)
+
 
+async def update_metrics(inference_queue, inference_event):
+    while True:
+        await inference_event.wait()  # set by the scraper after adding data
+        inference_event.clear()
+        while len(inference_queue) > 0:
+            new_data = inference_queue.popleft()
+            task = asyncio.create_task(detect_anomalies(new_data))
+            DETECTION_TASKS.add(task)
+            task.add_done_callback(detection_done)
+
+
+def detection_done(task):
+    DETECTION_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Failed to detect anomalies", exc_info=task.exception())
 
-async def update_metrics(inference_queue):
-    mad_dict = {}
 
+async def detect_anomalies(new_data):
+    cluster_id = new_data["cluster_id"]
+    loop = asyncio.get_running_loop()
+    shards = {
+        metric_name: hash((cluster_id, metric_name)) % len(EXECUTORS)
+        for metric_name in metrics_list
+        if len(new_data[metric_name]) > 0
+    }
+    executors = [EXECUTORS[shard] for shard in shards.values()]
+    results = await asyncio.gather(  # run MAD of the metrics in parallel
+        *(
+            loop.run_in_executor(
+                executor,
+                run_anomaly_detection,
+                cluster_id,
+                {metric_name: new_data[metric_name]},
+            )
+            for metric_name, executor in zip(shards, executors)
+        ),
+        return_exceptions=True,
+    )
+    metrics_payloads = []
+    for shard, executor, r in zip(shards.values(), executors, results):
+        if isinstance(r, Exception):
+            logger.error(f"failed to detect anomalies for cluster {cluster_id} : {r!r}")
+            if isinstance(r, BrokenProcessPool) and EXECUTORS[shard] is executor:
+                # the worker died, its detectors restart cold in a new one
+                logger.warning(f"restarting anomaly detection worker {shard}")
+                EXECUTORS[shard] = ProcessPoolExecutor(max_workers=1)
+                executor.shutdown(wait=False)
+        else:
+            metrics_payloads.extend(r)
+    pushed = await asyncio.gather(
+        *(push_metrics(json_payload) for json_payload in metrics_payloads),
+        return_exceptions=True,  # a failed push doesn't drop the other payloads
+    )
+    failed = [exception for exception in pushed if isinstance(exception, Exception)]
+    if failed:
+        logger.error(f"failed to push {len(failed)} payloads : {failed[0]!r}")
+
+    if ES_ENDPOINT:
+        ES_BUFFER.extend(metrics_payloads)
+        if len(ES_BUFFER) >= ES_FLUSH_SIZE:
+            await flush_es_buffer()
+
+
+async def flush_es_periodically():
+    """
+    index the buffered payloads to ES every ES_FLUSH_INTERVAL_SECOND, unless they were flushed
+    earlier by reaching ES_FLUSH_SIZE.
+    """
     while True:
-        new_data = await inference_queue.get()
-        cluster_id = new_data["cluster_id"]
-        if cluster_id not in mad_dict:
-            mad_dict[cluster_id] = {}
-            for metric_name in metrics_list:  # init models
-                mad = MetricAnomalyDetector(metric_name, cluster_id)
-                # await load_history_data(metric_name, mad)
-                mad_dict[cluster_id][metric_name] = mad
-        starttime = time.time()
-        metrics_payloads = []
-        for metric_name in metrics_list:
-            if len(new_data[metric_name]) == 0:
-                continue
-            json_payload = mad_dict[cluster_id][metric_name].run(
-                new_data[metric_name]
-            )  # run MAD
-            if json_payload:
-                push_metrics(json_payload)
-                metrics_payloads.append(json_payload)
-
-        if ES_ENDPOINT:
-            try:
-                async for ok, result in async_streaming_bulk(
-                    es, doc_generator(metrics_payloads)
-                ):
-                    action, result = result.popitem()
-                    if not ok:
-                        logging.error("failed to {} document {}".format())
-                logger.info("pushed to ES.")
-            except (BulkIndexError, ConnectionTimeout) as exception:
-                logging.error("Failed to index data")
-                logging.error(exception)
-
-
-async def doc_generator(metrics_payloads):
+        await asyncio.sleep(ES_FLUSH_INTERVAL_SECOND)
+        await flush_es_buffer()
+
+
+async def flush_es_buffer():
+    """
+    index the buffered payloads to ES, with bulk requests of at most ES_BULK_CHUNK_SIZE documents.
+    Up to ES_BULK_CONCURRENCY requests are sent concurrently.
+    """
+    while len(ES_BUFFER) > 0:
+        chunks = []
+        while len(ES_BUFFER) > 0 and len(chunks) < ES_BULK_CONCURRENCY:
+            chunks.append(
+                [
+                    ES_BUFFER.popleft()
+                    for _ in range(min(len(ES_BUFFER), ES_BULK_CHUNK_SIZE))
+                ]
+            )
+        await asyncio.gather(*(bulk_index(chunk) for chunk in chunks))
+
+
+async def bulk_index(metrics_payloads):
+    """
+    index the payloads to ES with a single bulk request.
+    """
+    try:
+        response = await es.bulk(
+            body=build_bulk_body(metrics_payloads),
+            index=ES_INDEX,
+            request_timeout=ES_BULK_REQUEST_TIMEOUT_SECOND,
+        )
+        if response["errors"]:
+            failed = [
+                item["index"] for item in response["items"] if "error" in item["index"]
+            ]
+            logger.error(f"failed to index {len(failed)} documents : {failed[0]}")
+        else:
+            logger.info(f"pushed {len(metrics_payloads)} documents to ES.")
+    except ElasticsearchException as exception:
+        logger.error("Failed to index data")
+        logger.error(exception)
+
+
+def build_bulk_body(metrics_payloads):
+    """
+    build the NDJSON body of a bulk request indexing the payloads.
+    """
+    lines = []
     for mp in metrics_payloads:
-        yield {
-            "_index": ES_INDEX,
-            "_id": uuid.uuid4(),
-            "_source": {
-                k: mp[k]
-                for k in mp
-                if not (isinstance(mp[k], str) and not mp[k])
-                and k not in ES_RESERVED_KEYWORDS
-            },
-        }
+        # one document per data point, indexing it again overwrites the document
+        doc_id = f"{mp['cluster_id']}:{mp['metric_name']}:{mp['timestamp_ms']}"
+        lines.append(orjson.dumps({"index": {"_id": doc_id}}))
+        lines.append(
+            orjson.dumps(
+                {k: mp[k] for k in ES_DOC_KEYS}, option=orjson.OPT_SERIALIZE_NUMPY
+            )
+        )
+    lines.append(b"")
+    return b"\n".join(lines)
 
 
 def convert_time(ts):
-    return datetime.fromtimestamp(float(ts)).strftime("%Y-%m-%d %H:%M:%S")
+    return format_second(int(float(ts)))
 
 
-async def scrape_prometheus_metrics(inference_queue):
-    starttime = time.time()
-    wait_time = (
-        int(starttime) // LOOP_TIME_SECOND * LOOP_TIME_SECOND
-        + LOOP_TIME_SECOND
-        - starttime
+@lru_cache(maxsize=128)
+def format_second(second):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+
+
+async def scrape_cluster_metrics(cluster_id, inference_queue, inference_event):
+    # metrics to collect.
+    inference_queue_payload = {
+        metric_name: [] for metric_name in PROMETHEUS_CUSTOM_QUERIES
+    }
+    inference_queue_payload["cluster_id"] = cluster_id
+    for result in await prom.custom_query(
+        query=PROMETHEUS_QUERY_ENCODED,
+        cluster_id=cluster_id,
+        encoded=True,
+    ):
+        inference_queue_payload[result["metric"]["metric_name"]].append(result)
+    logger.info(inference_queue_payload)
+    inference_queue.append(inference_queue_payload)
+    inference_event.set()
+
+
+async def scrape_prometheus_metrics(inference_queue, inference_event):
+    logger.info(
+        f"prom connect status check OK?: {await prom.check_prometheus_connection()}"
     )
+    wait_ns = LOOP_TIME_NS - time.time_ns() % LOOP_TIME_NS
+    wait_time = wait_ns / 1e9
+    # the scrapes are scheduled on the monotonic clock, in integer nanoseconds, so
+    # they don't drift with the time it takes to scrape or jump with the wall clock.
+    deadline_ns = time.monotonic_ns() + wait_ns
     await asyncio.sleep(wait_time)  # wait to the start of next minute
     starttime = time.time()
-    logger.info(f"wait time : {wait_time}, current time : {convert_time(starttime)}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            f"wait time : {wait_time}, current time : {convert_time(starttime)}"
+        )
     while True:
         thistime = time.time()
-        active_clusters = list_clusters()
-        for cluster_id in active_clusters:
-            # metrics to collect.
-            cpu_usage = prom.custom_query(
-                query=PROMETHEUS_CUSTOM_QUERIES["cpu_usage"],
-                cluster_id=cluster_id,
-            )
-            memory_usage = prom.custom_query(
-                query=PROMETHEUS_CUSTOM_QUERIES["memory_usage"],
-                cluster_id=cluster_id,
-            )
-            disk_usage = prom.custom_query(
-                query=PROMETHEUS_CUSTOM_QUERIES["disk_usage"],
-                cluster_id=cluster_id,
-            )
-            inference_queue_payload = {
-                "cluster_id": cluster_id,
-                "cpu_usage": cpu_usage,
-                "memory_usage": memory_usage,
-                "disk_usage": disk_usage,
-            }
-            logger.info(inference_queue_payload)
-            await inference_queue.put(inference_queue_payload)
-        await asyncio.sleep(  # to make sure it scrapes every LOOP_TIME seconds.
-            LOOP_TIME_SECOND - ((time.time() - starttime) % LOOP_TIME_SECOND)
+        active_clusters = await list_clusters()
+        scraped = await asyncio.gather(  # query the clusters concurrently
+            *(
+                scrape_cluster_metrics(cluster_id, inference_queue, inference_event)
+                for cluster_id in active_clusters
+            ),
+            return_exceptions=True,  # a failed cluster doesn't stop the others
         )
+        for cluster_id, result in zip(active_clusters, scraped):
+            if isinstance(result, Exception):
+                logger.error(f"failed to scrape cluster {cluster_id} : {result!r}")
+        deadline_ns += LOOP_TIME_NS
+        late_ns = time.monotonic_ns() - deadline_ns
+        if late_ns > 0:
+            missed = late_ns // LOOP_TIME_NS + 1
+            logger.warning(f"scraping took too long, skipping {missed} scrapes.")
+            deadline_ns += missed * LOOP_TIME_NS
+        await asyncio.sleep((deadline_ns - time.monotonic_ns()) / 1e9)
 
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
-    inference_queue = asyncio.Queue(loop=loop)
-    prometheus_scraper_coroutine = scrape_prometheus_metrics(inference_queue)
-    update_metrics_coroutine = update_metrics(inference_queue)
-
-    loop.run_until_complete(
-        asyncio.gather(prometheus_scraper_coroutine, update_metrics_coroutine)
+    # the scraper is the only producer and update_metrics the only consumer
+    inference_queue = deque()
+    inference_event = asyncio.Event()
+    prometheus_scraper_coroutine = scrape_prometheus_metrics(
+        inference_queue, inference_event
     )
+    update_metrics_coroutine = update_metrics(inference_queue, inference_event)
+    coroutines = [prometheus_scraper_coroutine, update_metrics_coroutine]
+    if ES_ENDPOINT:
+        coroutines.append(flush_es_periodically())
+
     try:
-        loop.run_forever()
+        loop.run_until_complete(asyncio.gather(*coroutines))
     finally:
+        loop.run_until_complete(prom.close())
+        loop.run_until_complete(gateway_client.aclose())
         loop.close()